@@ -1,17 +1,23 @@
 #!/usr/bin/python3
 
+import contextlib
 import datetime
 import glob
 import hashlib
 import json
 import logging
+import mmap
 import os
 import paho.mqtt.client as mqtt
 import psycopg2
 import psycopg2.extras
+import queue
 import smtplib
 import ssl
 import subprocess
+import threading
+import time
+import zlib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from os import path
@@ -26,13 +32,13 @@ Step 1: Generate the list of files with MEDIA_EXTENSIONS in MEDIA_LOCATIONS.
           -Do not prepend MEDIA_EXTENSIONS entries with a dot.
           -Entries need to be lowercase.
 Step 2: Scan the files.
-          -Files are processed alphabetically from the list generated in step 1.
+          -Files are processed in the order they are found in step 1, starting as soon as the first file is found.
           -Compares the file's last modified time with the stored value in the database. If file has been
            modified, a new checksum is generated and file is set to be validated.
           -Checksums expire after MEDIA_UPDATE_CHECKSUM_AFTER_DAYS, so any file that has a stored checksum
            older than this is set to be validated as well.
 Step 3: Validate the files.
-          -Files are processed in order their checksum from step 2 was generated, oldest to newest.
+          -Files are processed in the order step 2 sets them to be validated, starting as soon as the first one is set.
           -Using the command MEDIA_VALIDATE_COMMAND, test the file for validation. The default command decodes
            the file and any errors are output the the console. A valid file will have no console output, hence valid.
            This command, if changed, must return nothing to the console if the file is valid. Output is stripped
@@ -40,15 +46,31 @@ Step 3: Validate the files.
           -Checksums are calculated right before and after validation to ensure the file has not changed during
            validation as some videos can take a bit to check. Files will stay valid as long as the checksum
            does not change. Checksums are updated if the file is changed or after MEDIA_UPDATE_CHECKSUM_AFTER_DAYS.
+          -Extensions listed in MEDIA_VALIDATORS are checked in process instead of with MEDIA_VALIDATE_COMMAND, which
+           avoids starting a process for every file. None are enabled by default. These only check the file
+           structure and do not decode the audio. flac checks every frame header CRC-8, frame numbering, the sample
+           count in STREAMINFO and the last frame's CRC-16; damage inside other frames and the STREAMINFO MD5 are
+           not checked. mp3 walks every frame and checks layer III frame CRCs. ogg checks every page CRC and page
+           sequence. Set MEDIA_BENCHMARK_VALIDATORS to log the time taken by each
+           validator and any results that differ compared with MEDIA_VALIDATE_COMMAND before enabling one.
           -If a file changes during validation, it will be re-checked the next time this is run.
+          -If MEDIA_REUSE_DUPLICATE_RESULTS is set, a file with the same checksum and size as a file validated within
+           MEDIA_UPDATE_CHECKSUM_AFTER_DAYS reuses that result instead of being validated again. Hardlinked files
+           are only checksummed once per run.
 Step 4: Clean the database.
           -Checks all filenames in the database to ensure they exist on the filesystem. Records are deleted from the
            database if they do not exist on the filesystem.
+          -Starts once step 1 has finished and runs alongside steps 2 and 3.
 Step 5: Notify the user.
           -Sends an email with the list of invalid files if EMAIL_SMTP_SERVER is set.
           -Send an update over MQTT if MQTT_BROKER is set.
 
 NOTES
+  -Steps 1 to 4 run at the same time. The list of files from step 1 is kept in memory and never waits on the other
+   steps. Steps 2 and 3 hold at most MEDIA_PIPELINE_QUEUE_SIZE files waiting for them, so checksumming waits for
+   validation to catch up instead of running ahead of it. The MQTT step
+   shows every running step with its own count. The percent done and count follow step 3 once it has started and
+   step 2 before that.
   -I recommend running this script initially with a directory containing only a few files to ensure everything runs for you.
    After you ensure it runs, I set it up as a cron job. The script utilizes a lock file to prevent multiple processes from
    running.
@@ -56,8 +78,8 @@ NOTES
    which will take a while depending on your media library size. It only uses the POSTGRES_DATABASE_TABLENAME, so
    it can safely be used in a database containing other tables.
   -If you enable MQTT and use Home Assistant, disable logging for sensor.media_monitor_count unless you like
-   an exessively bloated database. Everytime a file is processed, an update is sent over MQTT. You may also
-   clear out HOMEASSISTANT_DISCOVERY_TOPIC_COUNT to not use publish to this entity.
+   an exessively bloated database. Progress is sent over MQTT up to once every MQTT_PROGRESS_INTERVAL_SECONDS.
+   You may also clear out HOMEASSISTANT_DISCOVERY_TOPIC_COUNT to not use publish to this entity.
   -Sample Home Assistant card:
 
 type: entities
@@ -110,13 +132,30 @@ MEDIA_EXTENSIONS: list = [
 # Must contain {filename} without quotes for string replacement; quotes are inserted.
 # Command must return no output to be considered a valid file.
 MEDIA_VALIDATE_COMMAND: str = "ffmpeg -v error -i {filename} -f null -"
+# Validator to use per extension, any extension not listed uses "command" (MEDIA_VALIDATE_COMMAND).
+# Available validators: command, flac, mp3, ogg
+# The in process validators only check the file structure and do not decode the audio, so they miss corruption a
+# full decode would catch. Compare them with MEDIA_BENCHMARK_VALIDATORS before enabling them,
+# e.g. {"flac": "flac", "mp3": "mp3", "ogg": "ogg"}
+MEDIA_VALIDATORS: dict = {}
+# Logs the time taken by each validator. Files checked by a validator other than "command" are also
+# checked with MEDIA_VALIDATE_COMMAND to compare times and results; the selected validator's result is kept.
+MEDIA_BENCHMARK_VALIDATORS: bool = False
 MEDIA_UPDATE_CHECKSUM_AFTER_DAYS: int = 180
+# Files with the same checksum and size as a file validated within MEDIA_UPDATE_CHECKSUM_AFTER_DAYS
+# reuse its result instead of being validated again.
+MEDIA_REUSE_DUPLICATE_RESULTS: bool = True
+# Steps 1 to 4 run at the same time. Checksumming waits for validation to catch up once this many files are
+# waiting to be validated.
+MEDIA_PIPELINE_QUEUE_SIZE: int = 1000
 
 MQTT_BROKER: str = "mqtt.domain.com"
 MQTT_PORT: int = 1883
 MQTT_USERNAME: str = "mqttusername"
 MQTT_PASSWORD: str = "mqttpassword"
 MQTT_TOPIC_BASE: str = "media_monitor"
+# Steps running at the same time send their progress at most once per this many seconds.
+MQTT_PROGRESS_INTERVAL_SECONDS: float = 1.0
 
 HOMEASSISTANT_DISCOVERY_TOPIC_STATUS: str = "homeassistant/sensor/media_monitor/config"
 HOMEASSISTANT_DISCOVERY_TOPIC_PERCENT_DONE: str = "homeassistant/sensor/media_monitor_percent_done/config"
@@ -264,28 +303,33 @@ class Database:
             filenames.append(record.filename)
         return filenames
 
-    def getFilesToValidate(self) -> list:
-        files: list = self.runQuery(
-            "SELECT filename FROM {table} WHERE is_valid IS NULL ORDER BY checksummed_on ASC;",
+    def getValidatedDuplicate(self, filename: str) -> Map:
+        return self.runQuery(
+            "SELECT duplicate.is_valid, duplicate.validated_on FROM {table} AS pending JOIN {table} AS duplicate ON duplicate.checksum = pending.checksum AND duplicate.size = pending.size AND duplicate.filename <> pending.filename WHERE pending.filename = {filename} AND duplicate.is_valid IS NOT NULL AND duplicate.validated_on > NOW() - INTERVAL {interval} ORDER BY duplicate.validated_on DESC LIMIT 1;",
             {
-                "table": sql.SQL(POSTGRES_DATABASE_TABLENAME)
-            }
+                "table": sql.SQL(POSTGRES_DATABASE_TABLENAME),
+                "filename": filename,
+                "interval": str(MEDIA_UPDATE_CHECKSUM_AFTER_DAYS) + " days"
+            },
+            True
         )
 
-        filenames: list = []
-        record: dict = None
-        for record in files:
-            filenames.append(record.filename)
-        return filenames
-
-    def setFileValidity(self, filename: str, isValid: bool) -> bool:
+    def setFileValidity(self, filename: str, isValid: bool, validatedOn: str = None) -> bool:
         isValidString: str = ["false", "true"][isValid]
+        validatedOnString: str = "NOW()"
+        if validatedOn:
+            validatedOnString = "{validated_on}"
+
+        parameters: dict = {
+            "table": sql.SQL(POSTGRES_DATABASE_TABLENAME),
+            "filename": filename
+        }
+        if validatedOn:
+            parameters["validated_on"] = str(validatedOn)
+
         record = self.runQuery(
-            "UPDATE {table} SET is_valid = " + isValidString + ", validated_on = NOW() WHERE filename = {filename} RETURNING *;",
-            {
-                "table": sql.SQL(POSTGRES_DATABASE_TABLENAME),
-                "filename": filename
-            }
+            "UPDATE {table} SET is_valid = " + isValidString + ", validated_on = " + validatedOnString + " WHERE filename = {filename} RETURNING *;",
+            parameters
         )
 
         if record:
@@ -293,49 +337,48 @@ class Database:
 
         raise Exception(f"Failed to set as {isValidString}.")
 
-    def needToUpdateChecksum(self, filename: str, lastModifiedOn: str) -> bool:
-        lastModifiedUnchange: str = self.runQuery(
-            "SELECT EXISTS (SELECT * FROM {table} WHERE filename = {filename} AND last_modified_on = {last_modified_on});",
+    def getChecksumRecord(self, filename: str, lastModifiedOn: str) -> Map:
+        return self.runQuery(
+            "SELECT checksum, size, is_valid, last_modified_on = {last_modified_on} AS is_unchanged, checksummed_on <= NOW() - INTERVAL {interval} AS is_expired FROM {table} WHERE filename = {filename};",
             {
                 "table": sql.SQL(POSTGRES_DATABASE_TABLENAME),
                 "filename": filename,
-                "last_modified_on": lastModifiedOn
+                "last_modified_on": lastModifiedOn,
+                "interval": str(MEDIA_UPDATE_CHECKSUM_AFTER_DAYS) + " days"
             },
             True
         )
-        if not lastModifiedUnchange:
+
+    def needToUpdateChecksum(self, record: Map) -> bool:
+        if not record or not record.checksum:
             return True
 
-        checksumExpired: str = self.runQuery(
-            "SELECT EXISTS (SELECT * FROM {table} WHERE filename = {filename} AND checksummed_on <= NOW() - INTERVAL {interval});",
+        return not record.is_unchanged or bool(record.is_expired)
+
+    def updateSize(self, filename: str):
+        updated = self.runQuery(
+            "UPDATE {table} SET size = {size} WHERE filename = {filename} RETURNING *;",
             {
                 "table": sql.SQL(POSTGRES_DATABASE_TABLENAME),
-                "filename": filename,
-                "interval": str(MEDIA_UPDATE_CHECKSUM_AFTER_DAYS) + " days"
-            },
-            True
+                "size": str(path.getsize(filename)),
+                "filename": filename
+            }
         )
-        if checksumExpired:
-            return True
 
-        return False
+        if not updated:
+            raise Exception(f"Failed to update size in database.")
 
-    def updateChecksum(self, filename: str):
+    def updateChecksum(self, filename: str) -> bool:
         lastModifiedOn: str = self.mediaMonitor.getLastModifiedOn(filename)
+        record: Map = self.getChecksumRecord(filename, lastModifiedOn)
 
-        if not self.needToUpdateChecksum(filename, lastModifiedOn):
-            return
+        if not self.needToUpdateChecksum(record):
+            # Records checksummed before sizes were stored are backfilled so they can be matched as duplicates.
+            if record.size is None:
+                self.updateSize(filename)
+            return record.is_valid is None
 
-        savedChecksum: str = self.runQuery(
-            "SELECT checksum FROM {table} WHERE filename = {filename};",
-            {
-                "table": sql.SQL(POSTGRES_DATABASE_TABLENAME),
-                "filename": filename
-            },
-            True
-        )
-
-        if not savedChecksum:
+        if not record:
             inserted = self.runQuery(
                 "INSERT INTO {table} (filename, last_modified_on) VALUES ({filename}, {last_modified_on}) RETURNING *;",
                 {
@@ -349,10 +392,11 @@ class Database:
                 raise Exception(f"Failed to create record in database.")
 
         updated = self.runQuery(
-            "UPDATE {table} SET checksum = {checksum}, checksummed_on = NOW(), validated_on = NULL, is_valid = NULL, last_modified_on = {last_modified_on} WHERE filename = {filename} RETURNING *;",
+            "UPDATE {table} SET checksum = {checksum}, size = {size}, checksummed_on = NOW(), validated_on = NULL, is_valid = NULL, last_modified_on = {last_modified_on} WHERE filename = {filename} RETURNING *;",
             {
                 "table": sql.SQL(POSTGRES_DATABASE_TABLENAME),
-                "checksum": self.mediaMonitor.getChecksum(filename),
+                "checksum": self.mediaMonitor.getCachedChecksum(filename),
+                "size": str(path.getsize(filename)),
                 "last_modified_on": lastModifiedOn,
                 "filename": filename
             }
@@ -361,6 +405,8 @@ class Database:
         if not updated:
             raise Exception(f"Failed to update record in database.")
 
+        return True
+
     def assertTableExists(self):
         self.runQuery(
             "CREATE TABLE IF NOT EXISTS {table} (filename TEXT PRIMARY KEY, checksum TEXT, checksummed_on TIMESTAMP WITHOUT TIME ZONE, validated_on TIMESTAMP WITHOUT TIME ZONE, is_valid BOOL, last_modified_on TIMESTAMP WITHOUT TIME ZONE NOT NULL);",
@@ -369,6 +415,21 @@ class Database:
             }
         )
 
+        self.runQuery(
+            "ALTER TABLE {table} ADD COLUMN IF NOT EXISTS size BIGINT;",
+            {
+                "table": sql.SQL(POSTGRES_DATABASE_TABLENAME)
+            }
+        )
+
+        self.runQuery(
+            "CREATE INDEX IF NOT EXISTS {index} ON {table} (checksum, size);",
+            {
+                "index": sql.Identifier(POSTGRES_DATABASE_TABLENAME.split(".")[1] + "_checksum_size_idx"),
+                "table": sql.SQL(POSTGRES_DATABASE_TABLENAME)
+            }
+        )
+
         doesTableExists: bool = self.runQuery(
             "SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_schema = {schema} AND table_name = {table});",
             {
@@ -489,18 +550,432 @@ class Mqtt:
             f"{index} / {count}"
         )
 
+class Validator:
+    validators: dict = {}
+    benchmarks: dict = {}
+
+    crc8Table: list = []
+    crc16Table: list = []
+    reversedBits: bytes = None
+
+    mp3Bitrates: dict = {
+        (3, 3): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+        (3, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+        (3, 1): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+        (2, 3): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+        (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+        (2, 1): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+    }
+    # ffmpeg resyncs over junk before the first mp3 frame, this is how far in it is searched for.
+    mp3SyncWindow: int = 65536
+    mp3SampleRates: dict = {
+        3: [44100, 48000, 32000],
+        2: [22050, 24000, 16000],
+        0: [11025, 12000, 8000]
+    }
+
+    def __init__(self):
+        self.validators = {
+            "command": self.command,
+            "flac": self.flac,
+            "mp3": self.mp3,
+            "ogg": self.ogg
+        }
+        self.benchmarks = {}
+
+        self.crc8Table = self.getCrcTable(0x07, 8)
+        self.crc16Table = self.getCrcTable(0x8005, 16)
+        self.reversedBits = bytes(
+            int(f"{i:08b}"[::-1], 2) for i in range(256)
+        )
+
+        for extension, name in MEDIA_VALIDATORS.items():
+            if name not in self.validators:
+                logging.error(f"Exiting. Unknown validator {name} for extension {extension}.")
+                exit()
+
+    def validate(self, filename: str) -> bool:
+        f, extension = os.path.splitext(filename.lower())
+        name: str = MEDIA_VALIDATORS.get(extension.lstrip("."), "command")
+
+        startedOn: float = time.perf_counter()
+        isValid: bool = self.validators[name](filename)
+
+        if MEDIA_BENCHMARK_VALIDATORS:
+            self.addBenchmark(name, time.perf_counter() - startedOn)
+
+            if name != "command":
+                startedOn = time.perf_counter()
+                commandIsValid: bool = self.command(filename)
+                self.addBenchmark(f"command ({name} files)", time.perf_counter() - startedOn)
+
+                if isValid != commandIsValid:
+                    logging.warning(f"Validator {name} returned {isValid} but command returned {commandIsValid} for file {filename}")
+
+        return isValid
+
+    def addBenchmark(self, name: str, seconds: float):
+        count, total = self.benchmarks.get(name, (0, 0.0))
+        self.benchmarks[name] = (count + 1, total + seconds)
+
+    def logBenchmarks(self):
+        for name, (count, total) in sorted(self.benchmarks.items()):
+            logging.info(f"Validator {name}: {count} files in {total:.2f}s, {total / count * 1000:.1f}ms per file")
+
+    def command(self, filename: str) -> bool:
+        process = subprocess.run(
+                f"{MEDIA_VALIDATE_COMMAND}".replace(
+                    "{filename}",
+                    '"' + filename + '"'
+                ),
+                capture_output=True,
+                shell=True
+            )
+        output = process.stdout.decode("utf-8").strip() + process.stderr.decode("utf-8").strip()
+
+        return output == ""
+
+    def flac(self, filename: str) -> bool:
+        # Structural check only. Walks the metadata blocks and every frame header, verifying header CRC-8s, that
+        # frame numbers are contiguous and that the frames add up to the sample count in STREAMINFO. Only the last
+        # frame's CRC-16 is checked, to catch truncation, as the standard library has no CRC-16 at C speed. Damage
+        # inside other frames and the STREAMINFO MD5 need "command" for a full decode.
+        with self.openFile(filename) as data:
+            if not data:
+                return False
+
+            offset: int = self.getId3v2Length(data)
+            if data[offset:offset + 4] != b"fLaC":
+                return False
+
+            offset += 4
+            totalSamples: int = None
+            maxFrameSize: int = 0
+            isLast: bool = False
+            while not isLast:
+                if offset + 4 > len(data):
+                    return False
+
+                isLast = bool(data[offset] & 0x80)
+                blockType: int = data[offset] & 0x7f
+                length: int = int.from_bytes(data[offset + 1:offset + 4], "big")
+                offset += 4
+                if blockType == 127 or offset + length > len(data):
+                    return False
+
+                if blockType == 0:
+                    if length != 34:
+                        return False
+
+                    streamInfo: int = int.from_bytes(data[offset:offset + 34], "big")
+                    maxFrameSize = (streamInfo >> 192) & 0xffffff
+                    totalSamples = (streamInfo >> 128) & 0xfffffffff
+
+                offset += length
+
+            if totalSamples is None:
+                return False
+
+            sync: bytes = data[offset:offset + 2]
+            if sync not in (b"\xff\xf8", b"\xff\xf9"):
+                return False
+
+            # Sync codes also turn up inside frame data, so only a header with a valid CRC-8 and the next
+            # expected frame or sample number counts as a frame.
+            isVariableBlockSize: bool = sync == b"\xff\xf9"
+            frameOffset: int = None
+            frames: int = 0
+            samples: int = 0
+            while offset != -1:
+                frame: tuple = self.getFlacFrameHeader(data, offset)
+                if frame and frame[0] == (samples if isVariableBlockSize else frames):
+                    frameOffset = offset
+                    frames += 1
+                    samples += frame[1]
+
+                offset = data.find(sync, offset + 2)
+
+            if frameOffset is None or (totalSamples and samples != totalSamples):
+                return False
+
+            # The last frame runs to the end of the file or to a trailing ID3v1 tag.
+            ends: list = [len(data)]
+            if data[-128:-125] == b"TAG":
+                ends.append(len(data) - 128)
+
+            return any(self.isFlacFrameValid(data, frameOffset, end, maxFrameSize) for end in ends)
+
+    def isFlacFrameValid(self, data: mmap.mmap, start: int, end: int, maxFrameSize: int) -> bool:
+        if end - start < 8 or (maxFrameSize and end - start > maxFrameSize):
+            return False
+
+        crc: int = self.getCrc(self.crc16Table, 16, 0, data[start:end - 2])
+        return crc == int.from_bytes(data[end - 2:end], "big")
+
+    def getFlacFrameHeader(self, data: mmap.mmap, offset: int) -> tuple:
+        start: int = offset
+        try:
+            blockSizeCode: int = data[offset + 2] >> 4
+            sampleRateCode: int = data[offset + 2] & 0x0f
+            channelAssignment: int = data[offset + 3] >> 4
+            sampleSizeCode: int = (data[offset + 3] >> 1) & 0x07
+            if not blockSizeCode or sampleRateCode == 15 or channelAssignment > 10 or sampleSizeCode == 3 or data[offset + 3] & 0x01:
+                return None
+
+            offset += 4
+            leadingOnes: int = 8 - (~data[offset] & 0xff).bit_length()
+            if leadingOnes == 1 or leadingOnes > 7:
+                return None
+
+            number: int = data[offset] & (0x7f >> leadingOnes)
+            for i in range(1, leadingOnes):
+                if data[offset + i] & 0xc0 != 0x80:
+                    return None
+
+                number = (number << 6) | (data[offset + i] & 0x3f)
+            offset += max(leadingOnes, 1)
+
+            blockSize: int = 0
+            if blockSizeCode == 1:
+                blockSize = 192
+            elif blockSizeCode <= 5:
+                blockSize = 576 << (blockSizeCode - 2)
+            elif blockSizeCode == 6:
+                blockSize = data[offset] + 1
+                offset += 1
+            elif blockSizeCode == 7:
+                blockSize = int.from_bytes(data[offset:offset + 2], "big") + 1
+                offset += 2
+            else:
+                blockSize = 256 << (blockSizeCode - 8)
+
+            if sampleRateCode == 12:
+                offset += 1
+            elif sampleRateCode in (13, 14):
+                offset += 2
+
+            if self.getCrc(self.crc8Table, 8, 0, data[start:offset]) != data[offset]:
+                return None
+        except IndexError:
+            return None
+
+        return (number, blockSize)
+
+    def mp3(self, filename: str) -> bool:
+        # Walks every frame header, verifying each frame is followed by another frame or a trailing tag and,
+        # for layer III frames carrying one, the CRC-16 over the header and side information. Free format
+        # streams don't store their frame length, so they are checked with "command" instead.
+        with self.openFile(filename) as data:
+            if not data:
+                return False
+
+            offset: int = 0
+            while tagLength := self.getId3v2Length(data, offset):
+                offset += tagLength
+
+            offset = self.getMp3FirstFrameOffset(data, offset)
+            if offset == -1:
+                return False
+
+            frames: int = 0
+            length: int = 0
+            while offset < len(data):
+                if self.isMp3Tag(data, offset):
+                    break
+
+                lastLength: int = length
+                length = self.getMp3FrameLength(data, offset)
+                if length is None:
+                    return self.command(filename)
+
+                if not length or offset + length > len(data):
+                    # Zero padding or less than a frame of junk after the last frame is accepted, as ffmpeg does.
+                    if frames and (len(data) - offset < lastLength or not data[offset:].strip(b"\x00")):
+                        break
+
+                    return False
+
+                frames += 1
+                offset += length
+
+            return frames > 0
+
+    def getMp3FirstFrameOffset(self, data: mmap.mmap, offset: int) -> int:
+        # A sync code only counts as the first frame when it is followed by another frame, a tag or the end of
+        # the file, as junk can contain sync codes too. Free format frames can't be followed, so one is only
+        # used when no other frame is found.
+        end: int = min(len(data), offset + self.mp3SyncWindow)
+        freeFormatOffset: int = -1
+        while (offset := data.find(b"\xff", offset, end)) != -1:
+            length: int = self.getMp3FrameLength(data, offset)
+            if length is None and freeFormatOffset == -1:
+                freeFormatOffset = offset
+
+            if length:
+                nextOffset: int = offset + length
+                if nextOffset >= len(data) or self.isMp3Tag(data, nextOffset) or self.getMp3FrameLength(data, nextOffset) != 0:
+                    return offset
+
+            offset += 1
+
+        return freeFormatOffset
+
+    def isMp3Tag(self, data: mmap.mmap, offset: int) -> bool:
+        return data[offset:offset + 3] == b"TAG" or data[offset:offset + 8] == b"APETAGEX" or data[offset:offset + 11] == b"LYRICSBEGIN"
+
+    def getMp3FrameLength(self, data: mmap.mmap, offset: int) -> int:
+        if offset + 4 > len(data):
+            return 0
+
+        header: int = int.from_bytes(data[offset:offset + 4], "big")
+        version: int = (header >> 19) & 0x03
+        layer: int = (header >> 17) & 0x03
+        hasCrc: bool = not (header >> 16) & 0x01
+        bitrateIndex: int = (header >> 12) & 0x0f
+        sampleRateIndex: int = (header >> 10) & 0x03
+        padding: int = (header >> 9) & 0x01
+        isMono: bool = (header >> 6) & 0x03 == 3
+        if header >> 21 != 0x7ff or version == 1 or not layer or bitrateIndex == 15 or sampleRateIndex == 3:
+            return 0
+
+        if not bitrateIndex:
+            return None
+
+        bitrate: int = self.mp3Bitrates[(3 if version == 3 else 2, layer)][bitrateIndex] * 1000
+        sampleRate: int = self.mp3SampleRates[version][sampleRateIndex]
+        length: int = 0
+        if layer == 3:
+            length = (12 * bitrate // sampleRate + padding) * 4
+        elif layer == 2 or version == 3:
+            length = 144 * bitrate // sampleRate + padding
+        else:
+            length = 72 * bitrate // sampleRate + padding
+
+        if hasCrc and layer == 1:
+            sideInfoLength: int = [17, 32][not isMono] if version == 3 else [9, 17][not isMono]
+            if offset + 6 + sideInfoLength > len(data):
+                return 0
+
+            crc: int = self.getCrc(self.crc16Table, 16, 0xffff, data[offset + 2:offset + 4] + data[offset + 6:offset + 6 + sideInfoLength])
+            if crc != int.from_bytes(data[offset + 4:offset + 6], "big"):
+                return 0
+
+        return length
+
+    def ogg(self, filename: str) -> bool:
+        # Walks every page, verifying its CRC-32, that page sequence numbers are contiguous per logical stream
+        # and that every stream is closed by an end of stream page.
+        with self.openFile(filename) as data:
+            if not data:
+                return False
+
+            sequences: dict = {}
+            endedStreams: set = set()
+            offset: int = 0
+            while offset < len(data):
+                if data[offset:offset + 4] != b"OggS" or offset + 27 > len(data) or data[offset + 4] != 0:
+                    return False
+
+                headerType: int = data[offset + 5]
+                serial: int = int.from_bytes(data[offset + 14:offset + 18], "little")
+                sequence: int = int.from_bytes(data[offset + 18:offset + 22], "little")
+                crc: int = int.from_bytes(data[offset + 22:offset + 26], "little")
+                headerLength: int = 27 + data[offset + 26]
+                if offset + headerLength > len(data):
+                    return False
+
+                pageLength: int = headerLength + sum(data[offset + 27:offset + headerLength])
+                if offset + pageLength > len(data):
+                    return False
+
+                if headerType & 0x02:
+                    if serial in sequences:
+                        return False
+
+                    sequences[serial] = 0
+
+                if sequences.get(serial) != sequence or serial in endedStreams:
+                    return False
+
+                page: bytes = data[offset:offset + 22] + b"\x00\x00\x00\x00" + data[offset + 26:offset + pageLength]
+                if self.getOggCrc(page) != crc:
+                    return False
+
+                sequences[serial] = sequence + 1
+                if headerType & 0x04:
+                    endedStreams.add(serial)
+
+                offset += pageLength
+
+            return bool(sequences) and len(endedStreams) == len(sequences)
+
+    def getOggCrc(self, data: bytes) -> int:
+        # Ogg uses the CRC-32 polynomial unreflected with no initial or final XOR. zlib computes the reflected
+        # form, so bit reversing the input and output gives the same result at C speed.
+        crc: int = zlib.crc32(data.translate(self.reversedBits), 0xffffffff) ^ 0xffffffff
+        return int(f"{crc:032b}"[::-1], 2)
+
+    def getCrcTable(self, polynomial: int, width: int) -> list:
+        topBit: int = 1 << (width - 1)
+        mask: int = (1 << width) - 1
+        table: list = []
+        for i in range(256):
+            crc: int = i << (width - 8)
+            for bit in range(8):
+                crc = ((crc << 1) ^ polynomial if crc & topBit else crc << 1) & mask
+            table.append(crc)
+
+        return table
+
+    def getCrc(self, table: list, width: int, crc: int, data: bytes) -> int:
+        mask: int = (1 << width) - 1
+        for byte in data:
+            crc = ((crc << 8) & mask) ^ table[(crc >> (width - 8)) ^ byte]
+
+        return crc
+
+    def getId3v2Length(self, data: mmap.mmap, offset: int = 0) -> int:
+        if data[offset:offset + 3] != b"ID3" or len(data) < offset + 10:
+            return 0
+
+        # Tag size is a 28 bit syncsafe integer excluding the 10 byte header and optional 10 byte footer.
+        length: int = 0
+        for byte in data[offset + 6:offset + 10]:
+            length = (length << 7) | (byte & 0x7f)
+
+        return length + 10 + (10 if data[offset + 5] & 0x10 else 0)
+
+    @contextlib.contextmanager
+    def openFile(self, filename: str):
+        with open(filename, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                yield None
+                return
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
 class MediaMonitor:
     db: Database = None
+    checksumDb: Database = None
+    validateDb: Database = None
     mqtt: Mqtt = None
+    validator: Validator = None
 
     files: list = []
+    filesListed: threading.Event = None
+    filesChanged: threading.Condition = None
+    checksums: dict = {}
+
+    checksumQueue: queue.Queue = None
+    validateQueue: queue.Queue = None
 
     actions: list = []
-    actionsIndex: int = 0
     actionsCount: int = 0
 
-    processIndex: int = 0
-    processCount: int = 0
+    progress: dict = {}
+    progressLock: threading.Lock = None
+    progressSentOn: float = 0.0
 
     lockFilename: str = None
 
@@ -509,23 +984,38 @@ class MediaMonitor:
 
         self.assertLock()
 
+        # Each step running in its own thread gets its own connection, cursors can not be shared between threads.
         self.db = Database(self)
+        self.checksumDb = Database(self)
+        self.validateDb = Database(self)
         self.mqtt = Mqtt()
+        self.validator = Validator()
+
+        self.filesListed = threading.Event()
+        self.filesChanged = threading.Condition()
+        self.checksumQueue = queue.Queue(MEDIA_PIPELINE_QUEUE_SIZE)
+        self.validateQueue = queue.Queue(MEDIA_PIPELINE_QUEUE_SIZE)
+        self.progressLock = threading.Lock()
 
         self.actions.append(self.generateFileList)
         self.actions.append(self.scanFiles)
         self.actions.append(self.checkFiles)
         self.actions.append(self.cleanDatabase)
-        self.actions.append(self.processInvalids)
 
-        self.actionsCount = len(self.actions)
+        self.actionsCount = len(self.actions) + 1
 
+        # Feeds step 2 from the list of files, so listing never waits for checksumming to catch up.
+        threads: list = [threading.Thread(target=self.queueFiles)]
+        threads[0].start()
         for action in self.actions:
-            self.actionsIndex += 1
-            self.processIndex = 0
-            self.processCount = 0
-            self.mqtt.updateCount(self.processIndex, self.processCount)
-            action()
+            thread: threading.Thread = threading.Thread(target=action)
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        self.processInvalids()
 
         self.mqtt.updateStatus("Done")
         self.mqtt.updateCount(0, 0)
@@ -560,99 +1050,178 @@ class MediaMonitor:
         if path.exists(self.lockFilename):
             logging.error(f"Exiting. Failed to delete lock file.")
 
+    def updateProgress(self, actionIndex: int, text: str, index: int, count: int = None):
+        with self.progressLock:
+            self.progress[actionIndex] = (text, index, count)
+            if time.monotonic() - self.progressSentOn < MQTT_PROGRESS_INTERVAL_SECONDS:
+                return
+
+            self.progressSentOn = time.monotonic()
+            progress: dict = dict(self.progress)
+
+        self.sendProgress(progress)
+
+    def clearProgress(self, actionIndex: int):
+        with self.progressLock:
+            self.progress.pop(actionIndex, None)
+            self.progressSentOn = time.monotonic()
+            progress: dict = dict(self.progress)
+
+        self.sendProgress(progress)
+
+    def sendProgress(self, progress: dict):
+        status: list = []
+        for actionIndex, (text, index, count) in sorted(progress.items()):
+            if count is None:
+                status.append(f"({actionIndex}/{self.actionsCount}) {text} {index}")
+            else:
+                status.append(f"({actionIndex}/{self.actionsCount}) {text} {index} / {count}")
+
+        if status:
+            self.mqtt.updateStatus(", ".join(status))
+
+        # The count topics follow validation once it has started and checksumming before that.
+        for actionIndex in (3, 2):
+            if actionIndex in progress:
+                text, index, count = progress[actionIndex]
+                self.mqtt.updateCount(index, count)
+                return
+
+        self.mqtt.updateCount(0, 0)
+
+    def getQueuedFiles(self, fileQueue: queue.Queue):
+        while (filename := fileQueue.get()) is not None:
+            yield filename
+
     def generateFileList(self):
-        self.mqtt.updateStatus(f"({self.actionsIndex}/{self.actionsCount}) Generating list of files")
-        for directory in MEDIA_LOCATIONS:
-            directory = directory.rstrip("/") + "/**/*.*"
-            for filename in glob.iglob(directory, recursive=True):
-                f, extension = os.path.splitext(filename.lower())
-                if not extension.lstrip(".") in MEDIA_EXTENSIONS:
-                    continue
+        try:
+            for directory in MEDIA_LOCATIONS:
+                directory = directory.rstrip("/") + "/**/*.*"
+                for filename in glob.iglob(directory, recursive=True):
+                    f, extension = os.path.splitext(filename.lower())
+                    if not extension.lstrip(".") in MEDIA_EXTENSIONS:
+                        continue
+
+                    with self.filesChanged:
+                        self.files.append(filename)
+                        self.filesChanged.notify()
+                    self.updateProgress(1, "Generating list of files", len(self.files))
+        finally:
+            with self.filesChanged:
+                self.filesListed.set()
+                self.filesChanged.notify()
+            self.clearProgress(1)
+
+    def queueFiles(self):
+        index: int = 0
+        try:
+            while True:
+                with self.filesChanged:
+                    self.filesChanged.wait_for(lambda: index < len(self.files) or self.filesListed.is_set())
+                    if index >= len(self.files):
+                        break
 
-                self.files.append(filename)
+                    filename: str = self.files[index]
 
-        self.files.sort()
+                index += 1
+                self.checksumQueue.put(filename)
+        finally:
+            self.checksumQueue.put(None)
 
     def scanFiles(self):
-        self.processIndex = 0
-        self.processCount = len(self.files)
-        for filename in self.files:
-            self.processIndex += 1
-            self.mqtt.updateStatus(f"({self.actionsIndex}/{self.actionsCount}) Checksumming files")
-            self.mqtt.updateCount(self.processIndex, self.processCount)
-            try:
-                self.db.updateChecksum(filename)
-            except Exception as e:
-                logging.error(f"Failed to checksum file {filename}: {str(e)}")
+        processIndex: int = 0
+        try:
+            for filename in self.getQueuedFiles(self.checksumQueue):
+                processIndex += 1
+                try:
+                    self.updateProgress(2, "Checksumming files", processIndex, len(self.files))
+                    if self.checksumDb.updateChecksum(filename):
+                        self.validateQueue.put(filename)
+                except Exception as e:
+                    logging.error(f"Failed to checksum file {filename}: {str(e)}")
+        finally:
+            self.validateQueue.put(None)
+            self.clearProgress(2)
 
     def checkFiles(self):
-        self.files = self.db.getFilesToValidate()
-        self.processIndex = 0
-        self.processCount = len(self.files)
-        for filename in self.files:
-            self.processIndex += 1
-            self.mqtt.updateStatus(f"({self.actionsIndex}/{self.actionsCount}) Processing files")
-            self.mqtt.updateCount(self.processIndex, self.processCount)
-            if not path.exists(filename):
-                continue
-                
+        processIndex: int = 0
+        for filename in self.getQueuedFiles(self.validateQueue):
+            processIndex += 1
             try:
+                self.updateProgress(3, "Processing files", processIndex, processIndex + self.validateQueue.qsize())
+                if not path.exists(filename):
+                    continue
+
+                if MEDIA_REUSE_DUPLICATE_RESULTS:
+                    duplicate: Map = self.validateDb.getValidatedDuplicate(filename)
+                    if duplicate:
+                        self.validateDb.setFileValidity(filename, duplicate.is_valid, duplicate.validated_on)
+                        if not duplicate.is_valid:
+                            self.mqtt.updateInvalidCount(
+                                len(
+                                    self.validateDb.getInvalidFiles()
+                                )
+                            )
+                        continue
+
                 isValid: bool = False
                 preChecksum: str = self.getChecksum(filename)
-                process = subprocess.run(
-                        f"{MEDIA_VALIDATE_COMMAND}".replace(
-                            "{filename}",
-                            '"' + filename + '"'
-                        ),
-                        capture_output=True,
-                        shell=True
-                    )
-                output = process.stdout.decode("utf-8").strip() + process.stderr.decode("utf-8").strip()
+                isValid = self.validator.validate(filename)
                 postChecksum: str = self.getChecksum(filename)
                 if preChecksum != postChecksum:
                     raise Exception(f"File changed during validation.")
-                
-                if output == "":
-                    isValid = True
 
-                self.db.setFileValidity(filename, isValid)
+                self.validateDb.setFileValidity(filename, isValid)
 
                 if not isValid:
                     self.mqtt.updateInvalidCount(
                         len(
-                            self.db.getInvalidFiles()
+                            self.validateDb.getInvalidFiles()
                         )
                     )
             except Exception as e:
                 logging.error(f"Failed to validate file {filename}: {str(e)}")
 
+        self.clearProgress(3)
+
+        if MEDIA_BENCHMARK_VALIDATORS:
+            self.validator.logBenchmarks()
+
     def cleanDatabase(self):
-        self.files = self.db.getAllFilenames()
-        self.processIndex = 0
-        self.processCount = len(self.files)
-        for filename in self.files:
-            self.processIndex += 1
-            self.mqtt.updateStatus(f"({self.actionsIndex}/{self.actionsCount}) Cleaning database")
-            self.mqtt.updateCount(self.processIndex, self.processCount)
+        # Only needs the complete list of files, so it runs alongside checksumming and validation.
+        self.filesListed.wait()
+        files: set = set(self.files)
+
+        filenames: list = self.db.getAllFilenames()
+        processIndex: int = 0
+        for filename in filenames:
+            processIndex += 1
+            self.updateProgress(4, "Cleaning database", processIndex, len(filenames))
+
+            if filename in files:
+                continue
 
             if not path.exists(filename):
-                self.db.deleteRecord(filename)
+                try:
+                    self.db.deleteRecord(filename)
+                except Exception as e:
+                    logging.error(f"Failed to delete record for file {filename}: {str(e)}")
+
+        self.clearProgress(4)
 
     def processInvalids(self):
-        self.files = self.db.getInvalidFiles()
-        self.processIndex = 0
-        self.processCount = len(self.files)
-        self.mqtt.updateStatus(f"({self.actionsIndex}/{self.actionsCount}) Writing output")
-        self.mqtt.updateInvalidCount(self.processCount)
+        files: list = self.db.getInvalidFiles()
+        self.mqtt.updateStatus(f"({self.actionsCount}/{self.actionsCount}) Writing output")
+        self.mqtt.updateInvalidCount(len(files))
 
-        if self.files and EMAIL_SMTP_SERVER:
+        if files and EMAIL_SMTP_SERVER:
             html: str = "<html><body><table><thead><tr><th>Filename</th></tr></thead><tbody>"
-            for filename in self.files:
+            for filename in files:
                 html = html + f"<tr><td>{filename}</td></tr>"
             html = html + "</tbody></table></body></html>"
 
             message: MIMEMultipart = MIMEMultipart("alternative")
-            message["Subject"] = f"Media Monitor Results: {self.processCount} Invalid"
+            message["Subject"] = f"Media Monitor Results: {len(files)} Invalid"
             message["From"] = EMAIL_SENDER_ADDRESS
             message["To"] = EMAIL_RECEIVER_ADDRESS
 
@@ -686,6 +1255,22 @@ class MediaMonitor:
         except:
             raise Exception(f"Failed to get checksum for file.")
 
+    def getCachedChecksum(self, filename: str) -> str:
+        if not path.exists(filename):
+            raise Exception(f"File does not exist.")
+
+        # Hardlinked paths share a device and inode, so their content is only hashed once per run. Files with a
+        # single link are never seen again, so they are not kept.
+        stat: os.stat_result = os.stat(filename)
+        if stat.st_nlink <= 1:
+            return self.getChecksum(filename)
+
+        key: tuple = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if key not in self.checksums:
+            self.checksums[key] = self.getChecksum(filename)
+
+        return self.checksums[key]
+
     def getLastModifiedOn(self, filename: str) -> str:
         if not path.exists(filename):
             raise Exception(f"File does not exist.")